@@ -1,6 +1,13 @@
 import os
 import logging
+import threading
 
+# Tesseract parallelism comes from the processing pool; keep its internal
+# OpenMP team to a single thread so workers don't oversubscribe the CPU.
+# Must be set before tesserocr is loaded.
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+from functools import partial
 from pathlib import Path
 from pyftpdlib.authorizers import DummyAuthorizer
 from pyftpdlib.servers import FTPServer
@@ -64,12 +71,25 @@ def setup_ftp_server():
     max_workers = int(os.getenv('PROCESSING_MAX_WORKERS', '4'))
     max_retries = int(os.getenv('PROCESSING_MAX_RETRIES', '3'))
     db_path = os.getenv('PROCESSING_DB_PATH', './processed.db')
-    handler.manager = ProcessingManager(processor, db_path=db_path, max_workers=max_workers, max_retries=max_retries)
+    ftp_worker_processes = int(os.getenv('FTP_WORKER_PROCESSES', '1'))
+    handler.manager_factory = partial(ProcessingManager, db_path=db_path, max_workers=max_workers, max_retries=max_retries)
+    if ftp_worker_processes == 1:
+        # Nothing is forked: build the manager now so bad configuration fails at startup.
+        handler.get_manager()
+    else:
+        # Each pre-forked FTP worker builds its own ProcessingManager on first upload
+        # (see ScannerHandler.get_manager), so no pools or connections cross a fork.
+        # Still check the database once here so bad configuration fails at startup.
+        ProcessingManager.init_db(db_path)
 
     server = FTPServer((ftp_host, ftp_port), handler)
     server.max_cons = 256
     server.max_cons_per_ip = 5
 
+    # Off the main thread: an unreachable OLLAMA_HOST or a slow model load must
+    # not hold up serving on the already-bound socket.
+    threading.Thread(target=processor.warm_up_model, name="ollama-warm-up", daemon=True).start()
+
     return server
 
 
@@ -127,11 +147,12 @@ def main():
 
         ftp_host = os.getenv('FTP_HOST', '0.0.0.0')
         ftp_port = int(os.getenv('FTP_PORT', '21'))
+        ftp_worker_processes = int(os.getenv('FTP_WORKER_PROCESSES', '1'))
 
-        logger.info(f"🚀 Starting FTP server on {ftp_host}:{ftp_port}")
+        logger.info(f"🚀 Starting FTP server on {ftp_host}:{ftp_port} with {ftp_worker_processes} worker process(es)")
         print(f"{Fore.GREEN}🚀 Server is now running! Press Ctrl+C to stop.{Style.RESET_ALL}\n")
 
-        server.serve_forever()
+        server.serve_forever(worker_processes=ftp_worker_processes)
     except KeyboardInterrupt:
         print(f"\n{Fore.YELLOW}⏹️  Shutting down server...{Style.RESET_ALL}")
         logger.info("Server stopped by user")
@@ -139,6 +160,10 @@ def main():
         print(f"\n{Fore.RED}❌ Error starting server: {e}{Style.RESET_ALL}")
         logger.error(f"Error starting server: {e}")
         raise
+    finally:
+        # serve_forever handles Ctrl+C itself and returns, in the parent and in
+        # every pre-forked child; flush this process's pending DB records either way.
+        ScannerHandler.shutdown_manager()
 
 
 if __name__ == "__main__":
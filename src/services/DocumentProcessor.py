@@ -1,15 +1,71 @@
 import logging
-import pytesseract
+import httpx
 import ollama
-import requests
 import os
+import pytesseract
+import re
+import tempfile
 
-from requests.auth import HTTPBasicAuth
+from blake3 import blake3
+from diskcache import Cache
 from datetime import datetime
 from pdf2image import convert_from_path
 
+try:
+    from tesserocr import PyTessBaseAPI, PSM
+except ImportError:
+    # tesserocr isn't installed where it has no wheels (e.g. Windows);
+    # OCR then falls back to a single batched tesseract CLI call per document.
+    PyTessBaseAPI = None
+
 logger = logging.getLogger(__name__)
 
+# Anything that isn't a (Unicode) letter, digit, underscore or hyphen.
+_SANITIZE_RE = re.compile(r'[^\w-]+')
+
+# Page counters: "Page 2 / 5" / "page 2 sur 5" anywhere, or a bare "1/3" alone on its
+# line. Other N/M (dates like "12/03", references like "123/45") are left intact.
+_PAGE_NUMBER_RE = re.compile(
+    r'\bpage\s*\d{1,3}\s*(?:/|sur|of)\s*\d{1,3}\b|^[ \t]*\d{1,3}[ \t]*/[ \t]*\d{1,3}[ \t]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Per-process Tesseract API, created by `_init_ocr_api` on the first OCR call.
+_ocr_api = None
+
+
+def _init_ocr_api(tessdata_path: str | None):
+    """
+    Initialize the Tesseract API of the current process.
+
+    Limits Tesseract to a single OpenMP thread (parallelism comes from the
+    processing pool) and loads the language data once for the lifetime of the process.
+
+    Args:
+        tessdata_path (str | None): Directory containing the Tesseract language data.
+    """
+    global _ocr_api
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+    if tessdata_path:
+        _ocr_api = PyTessBaseAPI(path=tessdata_path, lang='eng', psm=PSM.AUTO)
+    else:
+        _ocr_api = PyTessBaseAPI(lang='eng', psm=PSM.AUTO)
+
+
+def _ocr_page(image_path: str) -> str:
+    """
+    OCR a single rendered page with the Tesseract API of the current process.
+
+    Args:
+        image_path (str): Path to the rendered page image.
+
+    Returns:
+        str: Extracted text from the page.
+    """
+    _ocr_api.SetImageFile(image_path)
+    return _ocr_api.GetUTF8Text()
+
+
 class DocumentProcessor:
     """
     Handles OCR, AI naming, and Nextcloud upload of scanned documents.
@@ -27,22 +83,44 @@ class DocumentProcessor:
         Environment variables:
         - OLLAMA_HOST: Host URL for the Ollama AI service.
         - OLLAMA_MODEL: Model name for Ollama AI.
+        - OLLAMA_KEEP_ALIVE: How long Ollama keeps the model loaded after a request.
+        - OLLAMA_CACHE_DIR: Directory of the on-disk cache of AI responses.
         - NEXTCLOUD_URL: Base URL for Nextcloud.
         - NEXTCLOUD_USERNAME: Username for Nextcloud authentication.
         - NEXTCLOUD_PASSWORD: Password for Nextcloud authentication.
         - NEXTCLOUD_UPLOAD_PATH: Path in Nextcloud to upload files.
-        - TESSERACT_PATH: Path to the Tesseract OCR executable.
+        - TESSDATA_PREFIX: Directory containing the Tesseract language data.
+        - TESSERACT_PATH: Path to the Tesseract OCR executable (used when tesserocr is unavailable).
+        - OCR_DPI: Resolution used to rasterize PDF pages before OCR.
         """
         self.ollama_host = os.getenv('OLLAMA_HOST', 'http://localhost:11434')
         self.ollama_model = os.getenv('OLLAMA_MODEL', 'llama3.2')
+        self.ollama_keep_alive = os.getenv('OLLAMA_KEEP_ALIVE', '1h')
+        self._fn_cache = Cache(os.getenv('OLLAMA_CACHE_DIR', './ai_cache'))
         self.nextcloud_url = os.getenv('NEXTCLOUD_URL')
         self.nextcloud_username = os.getenv('NEXTCLOUD_USERNAME')
         self.nextcloud_password = os.getenv('NEXTCLOUD_PASSWORD')
         self.nextcloud_path = os.getenv('NEXTCLOUD_UPLOAD_PATH', '/Documents/Scanned')
 
+        # Shared HTTP/2 client so uploads reuse (and multiplex over) one pooled
+        # connection instead of paying a DNS + TCP + TLS handshake per document.
+        credentials = None
+        if self.nextcloud_username and self.nextcloud_password:
+            credentials = (self.nextcloud_username, self.nextcloud_password)
+        self.client = httpx.Client(
+            http2=True,
+            auth=credentials,
+            limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+            timeout=300,
+            verify=False
+        )
+
+        self.tessdata_path = os.getenv('TESSDATA_PREFIX')
+
         tesseract_path = os.getenv('TESSERACT_PATH')
         if tesseract_path and os.path.exists(tesseract_path):
             pytesseract.pytesseract.tesseract_cmd = tesseract_path
+        self.ocr_dpi = int(os.getenv('OCR_DPI', '200'))
 
     def extract_text_from_pdf(self, pdf_path: str) -> str:
         """
@@ -57,22 +135,89 @@ class DocumentProcessor:
         logger.info(f"Extracting text from PDF: {pdf_path}")
 
         try:
-            images = convert_from_path(pdf_path, dpi=300)
-
-            full_text = []
-            for i, image in enumerate(images):
-                logger.info(f"Processing page {i + 1}/{len(images)}")
-                text = pytesseract.image_to_string(image, lang='eng')
-                full_text.append(text)
+            # Render pages to disk instead of holding every page bitmap in memory;
+            # Tesseract loads each page straight from its file.
+            with tempfile.TemporaryDirectory() as output_folder:
+                image_paths = convert_from_path(
+                    pdf_path,
+                    dpi=self.ocr_dpi,
+                    grayscale=True,
+                    output_folder=output_folder,
+                    fmt='jpeg',
+                    paths_only=True
+                )
+
+                logger.info(f"Processing {len(image_paths)} pages")
+                if PyTessBaseAPI is not None:
+                    full_text = self._ocr_in_process(image_paths)
+                else:
+                    full_text = self._ocr_batch(image_paths, output_folder)
 
             combined_text = '\n\n'.join(full_text)
-            logger.info(f"Extracted {len(combined_text)} characters from {len(images)} pages")
+            logger.info(f"Extracted {len(combined_text)} characters from {len(image_paths)} pages")
             return combined_text
 
         except Exception as e:
             logger.error(f"Error during OCR: {e}")
             return ""
 
+    def _ocr_in_process(self, image_paths: list[str]) -> list[str]:
+        """
+        OCR pages in order with the Tesseract API of the current process.
+
+        Args:
+            image_paths (list[str]): Paths to the rendered page images, in page order.
+
+        Returns:
+            list[str]: Extracted text of each page.
+        """
+        if _ocr_api is None:
+            _init_ocr_api(self.tessdata_path)
+        return [_ocr_page(image_path) for image_path in image_paths]
+
+    def _ocr_batch(self, image_paths: list[str], output_folder: str) -> list[str]:
+        """
+        OCR all pages with a single tesseract CLI invocation.
+
+        Tesseract accepts a text file listing one image per line, so the process
+        is spawned and the language data loaded once per document, not per page.
+
+        Args:
+            image_paths (list[str]): Paths to the rendered page images, in page order.
+            output_folder (str): Directory in which to write the image list file.
+
+        Returns:
+            list[str]: Extracted text of each page.
+        """
+        list_path = os.path.join(output_folder, 'images.txt')
+        with open(list_path, 'w') as f:
+            f.write('\n'.join(image_paths))
+
+        text = pytesseract.image_to_string(list_path, lang='eng')
+        # Tesseract ends every page with a form feed.
+        return text.split('\f')[:len(image_paths)]
+
+    def warm_up_model(self):
+        """
+        Load the Ollama model ahead of the first document.
+
+        Sends a one-token request so the model weights are resident (and kept
+        resident for OLLAMA_KEEP_ALIVE) before any scan arrives. Blocks until the
+        model is loaded, so callers should run it on a background thread. Failures
+        are only logged: naming falls back to timestamps if Ollama stays unavailable.
+        """
+        logger.info(f"Warming up Ollama model: {self.ollama_model}")
+
+        try:
+            ollama.generate(
+                model=self.ollama_model,
+                prompt='ping',
+                options={'num_predict': 1},
+                keep_alive=self.ollama_keep_alive
+            )
+        except Exception as e:
+            logger.warning(f"Could not warm up Ollama model: {e}")
+
     def generate_filename_with_ai(self, ocr_text: str, original_filename: str) -> str:
         """
         Generate a descriptive filename using AI based on OCR text.
@@ -91,7 +236,9 @@ class DocumentProcessor:
             return f"scan_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
 
         try:
-            text_preview = ocr_text[:2000] if len(ocr_text) > 2000 else ocr_text
+            # Drop page counters and collapse OCR whitespace runs so the preview
+            # carries more content per token to the model.
+            text_preview = ' '.join(_PAGE_NUMBER_RE.sub(' ', ocr_text).split())[:1500]
 
             prompt = f"""Based on the following scanned document text, generate a concise, descriptive filename (without extension).
 The filename should:
@@ -108,19 +255,33 @@ Document text:
 
 Respond with ONLY the filename, nothing else."""
 
-            response = ollama.chat(
-                model=self.ollama_model,
-                messages=[{'role': 'user', 'content': prompt}]
-            )
-
-            suggested_name = response['message']['content'].strip()
+            # Identical previews (e.g. re-scanned documents) reuse the cached answer
+            # instead of paying for another LLM prefill.
+            cache_key = blake3(f"{self.ollama_model}|{text_preview}".encode()).hexdigest()
+            cached_name = self._fn_cache.get(cache_key)
+
+            if cached_name is None:
+                # A filename is only a handful of tokens: cap decoding and stop at
+                # the first newline rather than letting the model ramble.
+                response = ollama.generate(
+                    model=self.ollama_model,
+                    prompt=prompt,
+                    options={'num_ctx': 2048, 'num_predict': 24, 'temperature': 0.1, 'stop': ['\n']},
+                    keep_alive=self.ollama_keep_alive
+                )
+
+                raw_name = response['response'].strip()
+            else:
+                logger.info("Using cached AI response")
+                raw_name = cached_name
 
-            suggested_name = suggested_name.replace(' ', '_')
-            suggested_name = ''.join(c for c in suggested_name if c.isalnum() or c in '_-')
-            suggested_name = suggested_name.lower()
+            suggested_name = _SANITIZE_RE.sub('', raw_name.replace(' ', '_')).lower()
 
             if len(suggested_name) < 5:
                 suggested_name = f"{suggested_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            elif cached_name is None:
+                # Only keep usable answers, so an empty or junk reply is retried next time.
+                self._fn_cache.set(cache_key, raw_name)
 
             filename = f"{suggested_name}.pdf"
             logger.info(f"AI suggested filename: {filename}")
@@ -153,16 +314,14 @@ Respond with ONLY the filename, nothing else."""
             logger.info(f"Uploading to Nextcloud: {remote_path}")
 
             with open(local_path, 'rb') as f:
-                file_data = f.read()
-
-            response = requests.put(
-                upload_url,
-                data=file_data,
-                auth=HTTPBasicAuth(self.nextcloud_username, self.nextcloud_password),
-                headers={'Content-Type': 'application/pdf'},
-                timeout=300,
-                verify=False
-            )
+                response = self.client.put(
+                    upload_url,
+                    content=f,
+                    headers={
+                        'Content-Type': 'application/pdf',
+                        'Content-Length': str(os.fstat(f.fileno()).st_size)
+                    }
+                )
 
             if response.status_code in [201, 204]:
                 logger.info(f"Successfully uploaded to Nextcloud: {remote_path}")
@@ -174,13 +333,29 @@ Respond with ONLY the filename, nothing else."""
         except FileNotFoundError:
             logger.error(f"Local file not found: {local_path}")
             return False
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Network error uploading to Nextcloud: {e}")
             return False
         except Exception as e:
             logger.error(f"Error uploading to Nextcloud: {e}")
             return False
 
+    def prepare_document(self, pdf_path: str) -> str:
+        """
+        Run the deterministic part of the pipeline: OCR and AI naming.
+
+        Callers that retry uploads should call this once and reuse the result
+        rather than re-running OCR and the AI model on every attempt.
+
+        Args:
+            pdf_path (str): Path to the PDF file.
+
+        Returns:
+            str: Filename to use in Nextcloud.
+        """
+        ocr_text = self.extract_text_from_pdf(pdf_path)
+        return self.generate_filename_with_ai(ocr_text, os.path.basename(pdf_path))
+
     def process_document(self, pdf_path: str) -> bool:
         """
         Process a document through the complete pipeline.
@@ -199,9 +374,7 @@ Respond with ONLY the filename, nothing else."""
         logger.info(f"Processing document: {pdf_path}")
 
         try:
-            ocr_text = self.extract_text_from_pdf(pdf_path)
-
-            new_filename = self.generate_filename_with_ai(ocr_text, os.path.basename(pdf_path))
+            new_filename = self.prepare_document(pdf_path)
 
             if self.upload_to_nextcloud(pdf_path, new_filename):
                 logger.info(f"Document processing completed successfully: {new_filename}")
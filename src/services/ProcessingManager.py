@@ -1,65 +1,192 @@
 import logging
-import hashlib
+import queue
+import signal
 import sqlite3
+import threading
 import time
 import os
+from functools import partial
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from blake3 import blake3
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timezone
 
+from services.DocumentProcessor import DocumentProcessor
+
 logger = logging.getLogger(__name__)
 
+# Processed records are written in batches of up to _WRITE_BATCH_SIZE rows,
+# collected over at most _WRITE_BATCH_WINDOW seconds, to share one commit.
+_WRITE_BATCH_SIZE = 64
+_WRITE_BATCH_WINDOW = 0.5
+
+# Per-process DocumentProcessor, created by `_worker_init` in each processing worker.
+_processor = None
+
+
+def _worker_init():
+    global _processor
+    # Workers share the terminal's process group; leave Ctrl+C to the parent so
+    # in-flight documents finish while `shutdown` waits for them.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Each worker OCRs its document's pages in order with a single Tesseract
+    # instance: parallelism comes from this pool, so no OpenMP threads.
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    _processor = DocumentProcessor()
+
+
+def _blake3(file_path: str) -> str:
+    h = blake3(max_threads=blake3.AUTO)
+    h.update_mmap(file_path)
+    return h.hexdigest()
+
+
+def _process_with_retries(file_path: str, file_hash: str | None, max_retries: int) -> tuple[bool, str | None]:
+    logger.info("Processing document: %s", file_path)
+    # OCR and naming are deterministic: run them once and only retry the upload.
+    try:
+        new_filename = _processor.prepare_document(file_path)
+    except Exception as e:
+        logger.error("Unexpected error preparing %s: %s", file_path, e)
+        return False, file_hash
+
+    backoff = 1
+    for attempt in range(1, max_retries + 1):
+        try:
+            logger.info("Upload attempt %d for %s", attempt, file_path)
+            if _processor.upload_to_nextcloud(file_path, new_filename):
+                logger.info("Document processing completed successfully: %s", new_filename)
+                # New files skipped the up-front hash; compute it here rather than
+                # on the parent's result-dispatch thread.
+                if file_hash is None:
+                    file_hash = _blake3(file_path)
+                return True, file_hash
+            logger.warning("Upload failed for %s (attempt %d)", file_path, attempt)
+        except Exception as e:
+            logger.error("Unexpected error processing %s: %s", file_path, e)
+
+        if attempt < max_retries:
+            logger.info("Retrying in %ds...", backoff)
+            time.sleep(backoff)
+            backoff *= 2
+
+    logger.error("Failed to process file after %d attempts: %s", max_retries, file_path)
+    return False, file_hash
+
+
 class ProcessingManager:
     """
     Asynchronous processing manager:
-    - Submits PDF processing tasks to a ThreadPoolExecutor
-    - Tracks processed files by SHA256 checksum in a small SQLite DB
+    - Submits PDF processing tasks to a ProcessPoolExecutor, one DocumentProcessor per worker
+    - Tracks processed files by BLAKE3 checksum in a small SQLite DB (parent process only)
     - Retries processing with exponential backoff on failure
     - Removes files on success
     """
 
-    def __init__(self, processor, db_path: str = "./processed.db", max_workers: int = 4, max_retries: int = 3):
-        self.processor = processor
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+    def __init__(self, db_path: str = "./processed.db", max_workers: int = 4, max_retries: int = 3):
+        self.max_workers = max_workers
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_worker_init)
+        self._executor_lock = threading.Lock()
         self.max_retries = max_retries
         self.db_path = Path(db_path)
+        self._tls = threading.local()
         self._init_db()
 
-    def _init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        try:
-            conn.execute(
-                "CREATE TABLE IF NOT EXISTS processed (file_hash TEXT PRIMARY KEY, filename TEXT, processed_at TEXT)"
-            )
-            conn.commit()
-        finally:
-            conn.close()
+        self._pending = queue.Queue()
+        self._writer = threading.Thread(target=self._write_pending, name="processed-db-writer", daemon=True)
+        self._writer.start()
 
-    def _sha256(self, file_path: str) -> str:
-        h = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(8192), b""):
-                h.update(chunk)
-        return h.hexdigest()
+    def _conn(self) -> sqlite3.Connection:
+        # One long-lived connection per thread, instead of opening one per query.
+        conn = getattr(self._tls, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA mmap_size=268435456")
+            self._tls.conn = conn
+        return conn
 
-    def _is_already_processed(self, file_hash: str) -> bool:
-        conn = sqlite3.connect(self.db_path)
+    @classmethod
+    def init_db(cls, db_path: str):
+        """
+        Create or migrate the processed table and switch the DB to WAL, then close it.
+
+        Lets startup fail on an unusable PROCESSING_DB_PATH when the managers
+        themselves are only built later, in each pre-forked FTP worker.
+        """
+        conn = sqlite3.connect(db_path)
         try:
-            cur = conn.execute("SELECT 1 FROM processed WHERE file_hash = ?", (file_hash,))
-            return cur.fetchone() is not None
+            cls._init_schema(conn)
         finally:
             conn.close()
 
-    def _mark_processed(self, file_hash: str, filename: str):
-        conn = sqlite3.connect(self.db_path)
-        try:
+    def _init_db(self):
+        self._init_schema(self._conn())
+
+    @staticmethod
+    def _init_schema(conn: sqlite3.Connection):
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
             conn.execute(
-                "INSERT OR REPLACE INTO processed (file_hash, filename, processed_at) VALUES (?, ?, ?)",
-                (file_hash, filename, datetime.now(timezone.utc).isoformat())
+                "CREATE TABLE IF NOT EXISTS processed "
+                "(file_hash TEXT PRIMARY KEY, filename TEXT, processed_at TEXT, size INTEGER, mtime REAL)"
             )
-            conn.commit()
-        finally:
-            conn.close()
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(processed)")}
+            if "size" not in columns:
+                conn.execute("ALTER TABLE processed ADD COLUMN size INTEGER")
+            if "mtime" not in columns:
+                conn.execute("ALTER TABLE processed ADD COLUMN mtime REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS processed_size ON processed (size)")
+
+    def _has_size_candidate(self, size: int) -> bool:
+        cur = self._conn().execute("SELECT 1 FROM processed WHERE size = ? LIMIT 1", (size,))
+        return cur.fetchone() is not None
+
+    def _is_already_processed(self, file_hash: str) -> bool:
+        cur = self._conn().execute("SELECT 1 FROM processed WHERE file_hash = ?", (file_hash,))
+        return cur.fetchone() is not None
+
+    def _mark_processed(self, file_hash: str, filename: str, size: int, mtime: float):
+        self._pending.put((file_hash, filename, datetime.now(timezone.utc).isoformat(), size, mtime))
+
+    def _write_pending(self):
+        # Background writer: one transaction (and one fsync) per batch instead of per file.
+        # A None item is the shutdown sentinel, sent by `shutdown`.
+        stopping = False
+        while not stopping:
+            rows = [self._pending.get()]
+            deadline = time.monotonic() + _WRITE_BATCH_WINDOW
+            while len(rows) < _WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(self._pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stopping = None in rows
+            rows = [row for row in rows if row is not None]
+            if not rows:
+                continue
+            try:
+                with self._conn() as conn:
+                    conn.executemany(
+                        "INSERT INTO processed (file_hash, filename, processed_at, size, mtime) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(file_hash) DO UPDATE SET filename = excluded.filename, "
+                        "processed_at = excluded.processed_at, size = excluded.size, mtime = excluded.mtime",
+                        rows
+                    )
+            except Exception as e:
+                logger.error("Error recording %d processed file(s): %s", len(rows), e)
+
+    def shutdown(self):
+        """Wait for in-flight documents, then flush pending records to the DB."""
+        self.executor.shutdown(wait=True)
+        self._pending.put(None)
+        self._writer.join()
 
     def submit_file(self, file_path: str):
         if not file_path.lower().endswith(".pdf"):
@@ -69,41 +196,76 @@ class ProcessingManager:
             logger.warning("submit_file: file does not exist: %s", file_path)
             return
 
-        file_hash = self._sha256(file_path)
-        if self._is_already_processed(file_hash):
-            logger.info("File already processed (checksum match), deleting local copy: %s", file_path)
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                logger.error("Error deleting duplicate local file: %s", e)
-            return
+        # Only hash up front when a processed file of the same size exists;
+        # otherwise the upload cannot be a duplicate and is hashed after processing.
+        file_hash = None
+        if self._has_size_candidate(os.path.getsize(file_path)):
+            file_hash = _blake3(file_path)
+            if self._is_already_processed(file_hash):
+                logger.info("File already processed (checksum match), deleting local copy: %s", file_path)
+                try:
+                    os.remove(file_path)
+                except Exception as e:
+                    logger.error("Error deleting duplicate local file: %s", e)
+                return
 
         logger.info("Enqueuing file for processing: %s", file_path)
-        self.executor.submit(self._process_with_retries, file_path, file_hash)
+        self._submit(file_path, file_hash)
 
-    def _process_with_retries(self, file_path: str, file_hash: str):
-        backoff = 1
-        for attempt in range(1, self.max_retries + 1):
-            try:
-                logger.info("Processing attempt %d for %s", attempt, file_path)
-                success = self.processor.process_document(file_path)
-                if success:
-                    self._mark_processed(file_hash, os.path.basename(file_path))
-                    try:
-                        os.remove(file_path)
-                        logger.info("Deleted processed file: %s", file_path)
-                    except Exception as e:
-                        logger.error("Error deleting file after processing: %s", e)
-                    return
-                else:
-                    logger.warning("Processor returned False for %s (attempt %d)", file_path, attempt)
-            except Exception as e:
-                logger.error("Unexpected error processing %s: %s", file_path, e)
+    def _submit(self, file_path: str, file_hash: str | None, crashes: int = 0):
+        executor = self.executor
+        try:
+            future = executor.submit(_process_with_retries, file_path, file_hash, self.max_retries)
+        except BrokenProcessPool:
+            # The pool died since the last callback noticed; replace it and retry once.
+            executor = self._reset_executor(executor)
+            future = executor.submit(_process_with_retries, file_path, file_hash, self.max_retries)
+        future.add_done_callback(partial(self._on_processed, file_path, file_hash, crashes, executor))
+
+    def _reset_executor(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        # A worker that dies abruptly (segfault, OOM kill) breaks the whole pool;
+        # every pending future fails with BrokenProcessPool and new submits raise.
+        with self._executor_lock:
+            if self.executor is broken:
+                logger.error("Processing pool is broken, starting a new one")
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_worker_init)
+            executor = self.executor
+        broken.shutdown(wait=False, cancel_futures=True)
+        return executor
 
-            if attempt < self.max_retries:
-                logger.info("Retrying in %ds...", backoff)
-                time.sleep(backoff)
-                backoff *= 2
+    def _on_processed(self, file_path: str, file_hash: str | None, crashes: int, executor: ProcessPoolExecutor, future: Future):
+        # Runs back in the parent process, so workers never touch SQLite.
+        try:
+            success, file_hash = future.result()
+            if not success:
+                return
+        except BrokenProcessPool as e:
+            self._reset_executor(executor)
+            # The file is left in place; resubmit it unless it keeps taking workers down.
+            if crashes + 1 < self.max_retries:
+                logger.error("Processing worker crashed for %s, resubmitting: %s", file_path, e)
+                try:
+                    self._submit(file_path, file_hash, crashes + 1)
+                except Exception as e:
+                    logger.error("Error resubmitting %s: %s", file_path, e)
+            else:
+                logger.error("Processing worker crashed %d times for %s, leaving it in place", crashes + 1, file_path)
+            return
+        except BaseException as e:
+            # Anything a worker hands back (even KeyboardInterrupt/SystemExit) must
+            # not escape: it would kill the executor's result-dispatch thread.
+            logger.error("Processing worker failed for %s: %r", file_path, e)
+            return
 
-        logger.error("Failed to process file after %d attempts: %s", self.max_retries, file_path)
+        try:
+            stat = os.stat(file_path)
+            self._mark_processed(file_hash, os.path.basename(file_path), stat.st_size, stat.st_mtime)
+        except Exception as e:
+            logger.error("Error recording processed file %s: %s", file_path, e)
+            return
 
+        try:
+            os.remove(file_path)
+            logger.info("Deleted processed file: %s", file_path)
+        except Exception as e:
+            logger.error("Error deleting file after processing: %s", e)
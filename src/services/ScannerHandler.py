@@ -1,6 +1,5 @@
 import logging
 import os
-import magic
 from pyftpdlib.handlers import FTPHandler
 
 logger = logging.getLogger(__name__)
@@ -19,12 +18,39 @@ class ScannerHandler(FTPHandler):
 
     processor = None
     manager = None
+    manager_factory = None
+    _manager_pid = None
 
+    @classmethod
+    def get_manager(cls):
+        """
+        Return the ProcessingManager of the current process.
+
+        With a pre-forked server every worker process builds its own manager from
+        `manager_factory` on first use, instead of sharing one created before the fork.
+        """
+        if cls.manager_factory is not None and cls._manager_pid != os.getpid():
+            cls.manager = cls.manager_factory()
+            cls._manager_pid = os.getpid()
+        return cls.manager
+
+    @classmethod
+    def shutdown_manager(cls):
+        """Shut down the ProcessingManager of the current process, if it created one."""
+        if cls.manager is not None and cls._manager_pid in (None, os.getpid()):
+            cls.manager.shutdown()
+
+    @staticmethod
     def is_real_pdf(file_path):
         """Check if PDF file is valid, prevent from nullbytes, etc..."""
         try:
-            mime = magic.from_file(file_path, mime=True)
-            return mime == 'application/pdf'
+            with open(file_path, 'rb') as f:
+                if f.read(5) != b'%PDF-':
+                    return False
+                # The %%EOF marker may be followed by a few bytes of trailing whitespace/garbage.
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - 1024))
+                return b'%%EOF' in f.read()
         except Exception as e:
             logger.error(f"Error checking file type: {e}")
             return False
@@ -52,7 +78,7 @@ class ScannerHandler(FTPHandler):
         """
         logger.info(f"File received: {file_path}")
 
-        if not file_path.lower().endswith('.pdf') or not is_real_pdf(file_path):
+        if not file_path.lower().endswith('.pdf') or not self.is_real_pdf(file_path):
             logger.warning("Skipping non-PDF file: %s", os.path.basename(file_path))
             return
 
@@ -73,9 +99,15 @@ class ScannerHandler(FTPHandler):
             )
             return
 
-        if self.manager:
+        try:
+            manager = self.get_manager()
+        except Exception as e:
+            logger.error("Error creating processing manager, leaving file in place: %s", e)
+            return
+
+        if manager:
             try:
-                self.manager.submit_file(file_path)
+                manager.submit_file(file_path)
                 logger.info("File enqueued for asynchronous processing: %s", file_path)
             except Exception as e:
                 logger.error("Error enqueuing file for processing: %s", e)